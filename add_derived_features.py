@@ -2,61 +2,53 @@ import numpy as np
 import datetime
 import pandas as pd
 import os
+import heapq
+import orjson
+from concurrent.futures import ProcessPoolExecutor
 from loop_to_python_api.api import get_glucose_velocity_values_and_dates, get_active_insulin
 import click
 
 # TODO: ADD INSULIN TYPES FOR CORRECT COMPUTATION! Currently assuming rapid-acting insulin
 def get_json_loop_prediction_input_from_df(data, basal=None, isf=None, cr=None):
     def get_dates_and_values(column, data):
-        mask = ~data[column].isna()  # ~ inverts the boolean mask
-        dates = data.index[mask].to_list()
-        values = data[column][mask].to_list()
-        return dates, values
+        mask = data[column].notna()
+        return data.index[mask], data[column][mask].to_numpy()
+
+    def get_date_strings(dates):
+        return dates.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     data.sort_index(inplace=True)
     bolus_dates, bolus_values = get_dates_and_values('bolus', data)
     basal_dates, basal_values = get_dates_and_values('basal', data)
 
-    insulin_json_list = []
-    for date, value in zip(bolus_dates, bolus_values):
-        entry = {
-            "startDate": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "endDate": (date + datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "type": 'bolus',
-            "volume": value
-        }
-        insulin_json_list.append(entry)
-
-    for date, value in zip(basal_dates, basal_values):
-        entry = {
-            "startDate": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "endDate": (date + datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "type": 'basal',
-            "volume": value / 12 # Converting from U/hr to delivered units in 5 minutes
-        }
-        insulin_json_list.append(entry)
-    insulin_json_list.sort(key=lambda x: x['startDate'])
+    # The index is sorted, so all lists below are already in chronological order
+    bolus_json_list = pd.DataFrame({
+        "startDate": get_date_strings(bolus_dates),
+        "endDate": get_date_strings(bolus_dates + pd.Timedelta(minutes=5)),
+        "type": 'bolus',
+        "volume": bolus_values
+    }).to_dict(orient='records')
+
+    basal_json_list = pd.DataFrame({
+        "startDate": get_date_strings(basal_dates),
+        "endDate": get_date_strings(basal_dates + pd.Timedelta(minutes=5)),
+        "type": 'basal',
+        "volume": basal_values / 12  # Converting from U/hr to delivered units in 5 minutes
+    }).to_dict(orient='records')
+    insulin_json_list = list(heapq.merge(bolus_json_list, basal_json_list, key=lambda x: x['startDate']))
 
     bg_dates, bg_values = get_dates_and_values('CGM', data)
-    bg_json_list = []
-    for date, value in zip(bg_dates, bg_values):
-        entry = {
-            "date": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "value": value
-        }
-        bg_json_list.append(entry)
-    bg_json_list.sort(key=lambda x: x['date'])
+    bg_json_list = pd.DataFrame({
+        "date": get_date_strings(bg_dates),
+        "value": bg_values
+    }).to_dict(orient='records')
 
     carbs_dates, carbs_values = get_dates_and_values('carbs', data)
-    carbs_json_list = []
-    for date, value in zip(carbs_dates, carbs_values):
-        entry = {
-            "date": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "grams": value,
-            "absorptionTime": 10800,
-        }
-        carbs_json_list.append(entry)
-    carbs_json_list.sort(key=lambda x: x['date'])
+    carbs_json_list = pd.DataFrame({
+        "date": get_date_strings(carbs_dates),
+        "grams": carbs_values,
+        "absorptionTime": 10800,
+    }).to_dict(orient='records')
 
     # It is important that the setting dates encompass the data to avoid a code crash
     if len(bg_json_list) > 0:
@@ -113,45 +105,81 @@ def get_json_loop_prediction_input_from_df(data, basal=None, isf=None, cr=None):
 
 
 def get_df_from_file_path(file_path):
-    return pd.read_csv(file_path, index_col='date', parse_dates=['date'], low_memory=False)
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    df = pd.read_csv(file_path, engine='pyarrow', parse_dates=['date']).set_index('date')
+    # The pyarrow engine parses dates with second resolution, so restore the nanosecond index of the default engine
+    df.index = df.index.as_unit('ns')
+    return df
 
 
-def get_json_data_with_prediction_date(json_data, prediction_date):
-    json_data["predictionStart"] = prediction_date.strftime('%Y-%m-%dT%H:%M:%SZ')
-    return json_data
+def save_df_to_file_path(df, file_path, parquet=False):
+    if parquet or file_path.endswith('.parquet'):
+        df.to_parquet(os.path.splitext(file_path)[0] + '.parquet', compression='zstd', row_group_size=100_000)
+    else:
+        df.to_csv(file_path)
+
+
+# Loop input shared by the iob worker processes, set once per process by the pool initializer
+_iob_json_data = None
+
+
+def _init_iob_worker(json_bytes):
+    global _iob_json_data
+    _iob_json_data = orjson.loads(json_bytes)
+
+
+def _iob_worker(prediction_start):
+    _iob_json_data["predictionStart"] = prediction_start
+    return get_active_insulin(_iob_json_data)
 
 
 def add_col(df, col):
-    user_ids = df['id'].unique()
+    # Results are written by row position into one array and assigned once after the loop, as the date index is
+    # shared between users and cannot be used to align the results
+    if col in df.columns:
+        col_values = df[col].to_numpy(dtype=float, copy=True)
+    else:
+        col_values = np.full(len(df), np.nan)
+    skipped_user_ids = []
 
-    for user_id in user_ids:
-        user_data = df[df['id'] == user_id].copy()
-        user_data.sort_index(inplace=True)
+    for user_id, positions in df.groupby('id', sort=False).indices.items():
+        positions = positions[np.argsort(df.index[positions], kind='stable')]
+        user_data = df.iloc[positions].copy()
 
         if col in user_data.columns:
             if user_data[col].notna().sum() > 0:
                 print("User", user_id, f"already has {col} values. Skipping...")
                 continue
 
-        # Use total daily insulin to calculate therapy settings
-        user_data['insulin'] = user_data['bolus'] + (user_data['basal'] / 12)
+        # Use total daily insulin to calculate therapy settings, using only the training data from the first CGM value
+        first_valid_index = user_data['CGM'].first_valid_index()
+        is_used = ~user_data['is_test'].to_numpy(dtype=bool)
+        if first_valid_index is not None:
+            is_used &= user_data.index >= first_valid_index
+        insulin = user_data['bolus'].to_numpy()[is_used] + (user_data['basal'].to_numpy()[is_used] / 12)
+        days = user_data.index.to_numpy()[is_used].astype('datetime64[D]')
 
         # Get therapy setting estimates
         SAMPLES_PER_DAY = 288  # 24 hours * 12 (12 samples per hour for 5-minute intervals)
-        # Group data by day
-        first_valid_index = user_data['CGM'].first_valid_index()
-        daily_data = (
-            user_data.loc[first_valid_index:][user_data['is_test'] == False]
-            .groupby(pd.Grouper(freq='D'))['insulin']
-            .agg(['count', 'sum'])  # Count samples and sum non-NaN values per day
-        ).iloc[1:]
-        daily_data['scaled_insulin'] = daily_data['sum'] * (SAMPLES_PER_DAY / daily_data['count'])
-        daily_data['scaled_insulin'] = daily_data['scaled_insulin'].where(daily_data['count'] > 0, np.nan)
-
-        daily_avg_insulin = daily_data['scaled_insulin'].mean()
+        # Group data by day. The data is sorted, so each day is a contiguous block, and the first day is left out
+        day_starts = np.flatnonzero(days[1:] != days[:-1]) + 1
+        daily_avg_insulin = np.nan
+        if len(day_starts) > 0:
+            insulin = insulin[day_starts[0]:]
+            day_starts = day_starts - day_starts[0]
+            # Count samples and sum non-NaN values per day
+            daily_count = np.add.reduceat((~np.isnan(insulin)).astype(np.int64), day_starts)
+            daily_sum = np.add.reduceat(np.nan_to_num(insulin), day_starts)
+            has_samples = daily_count > 0
+            if has_samples.any():
+                scaled_insulin = daily_sum[has_samples] * (SAMPLES_PER_DAY / daily_count[has_samples])
+                daily_avg_insulin = scaled_insulin.mean()
+
         if np.isnan(daily_avg_insulin):
             print(f"Warning: No valid data for user {user_id}, skipping...")
-            df = df[df['user_id'] != user_id]
+            skipped_user_ids.append(user_id)
+            continue
         else:
             print(f"Average daily insulin for user {user_id}: {daily_avg_insulin}")
 
@@ -169,41 +197,39 @@ def add_col(df, col):
             values, dates = get_glucose_velocity_values_and_dates(json_data)
             # Only proceed if we have data
             if len(values) > 0 and len(dates) > 0:
-                values = [value * 60 * 5 for value in values]
-                dates = [datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S%z") for date in dates]
-                col_df = pd.DataFrame({
-                    col: values,
-                    'date': dates
-                })
-                col_df.set_index('date', inplace=True)
+                # Parse the dates as UTC, and drop the timezone to match the naive index of the main df
+                dates = pd.to_datetime(dates, format="%Y-%m-%dT%H:%M:%S%z", utc=True).tz_localize(None)
+                col_df = pd.DataFrame({col: np.asarray(values, dtype=float) * 60 * 5}, index=dates)
                 print(f"Number of {col} values:", len(col_df))
 
-                # Convert to UTC if it is not already
-                if col_df.index.tz is not None:
-                    col_df.index = col_df.index.tz_localize(None)
-
                 # Adding ice values to the user id in the main df
-                mask = (df['id'] == user_id)
-                df.loc[mask, col] = col_df[col]
+                col_values[positions] = col_df[col].reindex(user_data.index).to_numpy()
             else:
-                mask = (df['id'] == user_id)
-                df.loc[mask, col] = np.nan
+                col_values[positions] = np.nan
                 print(f"No {col} values for user", user_id)
 
-            print("Number of non-NA ICE values:", df[col].notna().sum())
-            print("Users with non nan ice values", df[df[col].notna()]['id'].unique())
-
         elif col == 'iob':
-            user_data[col] = user_data.apply(lambda row: get_active_insulin(get_json_data_with_prediction_date(json_data, row.name)), axis=1)
-
-            # Adding ice values to the user id in the main df
-            mask = (df['id'] == user_id)
-            df.loc[mask, col] = user_data[col]
+            prediction_starts = user_data.index.strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
+            # Serialized once, so each worker receives a single bytes payload instead of the pickled nested dict
+            json_bytes = orjson.dumps(json_data, option=orjson.OPT_SERIALIZE_NUMPY)
+            with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_iob_worker,
+                                     initargs=(json_bytes,)) as executor:
+                user_data[col] = list(executor.map(_iob_worker, prediction_starts, chunksize=256))
+
+            # Adding iob values to the user id in the main df
+            col_values[positions] = user_data[col].to_numpy()
             print(user_data)
 
         else:
             ValueError(f"No column named {col}. Must either be iob or ice")
 
+    df[col] = col_values
+    if skipped_user_ids:
+        df = df[~df['id'].isin(skipped_user_ids)]
+
+    print(f"Number of non-NA {col} values:", df[col].notna().sum())
+    print(f"Users with non nan {col} values", df[df[col].notna()]['id'].unique())
+    return df
 
 
 @click.group()
@@ -213,18 +239,20 @@ def cli():
 
 @cli.command()
 @click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
-def add_ice(file_path):
+@click.option('--parquet', is_flag=True, help='Save as zstd-compressed Parquet next to the input instead of overwriting it.')
+def add_ice(file_path, parquet):
     df = get_df_from_file_path(file_path)
     df = add_col(df, 'ice')
-    df.to_csv(file_path)
+    save_df_to_file_path(df, file_path, parquet)
 
 
 @cli.command()
 @click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
-def add_iob(file_path):
+@click.option('--parquet', is_flag=True, help='Save as zstd-compressed Parquet next to the input instead of overwriting it.')
+def add_iob(file_path, parquet):
     df = get_df_from_file_path(file_path)
     df = add_col(df, 'iob')
-    df.to_csv(file_path)
+    save_df_to_file_path(df, file_path, parquet)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,12 @@
 import os
 import sys
+import mmap
 import tempfile
 import subprocess
+import traceback
 from tqdm import tqdm
-from collections import Counter
-import math
+import numpy as np
+from numba import njit
 import click
 
 
@@ -23,14 +25,26 @@ def estimate_true_information(path, temp_dir=None):
             os.remove(temp_archive)
 
         print("Compressing data...")
-        # Compress the directory/file using zstd with maximum compression
+        # Compress the directory/file using zstd with maximum compression, on all cores and with a long-range window
+        zstd_cmd = ['zstd', '-22', '-T0', '--long=27', '--force', '-o', temp_archive]
         if os.path.isdir(path):
-            cmd = f'tar -cf - -C "{os.path.dirname(path)}" "{os.path.basename(path)}" | zstd -22 --force -o "{temp_archive}"'
-            print(f"Running command: {cmd}")
-            subprocess.run(cmd, shell=True, check=True, stderr=subprocess.PIPE)
+            path = os.path.abspath(path)
+            tar_cmd = ['tar', '-cf', '-', '-C', os.path.dirname(path), os.path.basename(path)]
+            print(f"Running command: {' '.join(tar_cmd)} | {' '.join(zstd_cmd)}")
+            # Pipe tar straight into zstd, so the archive is streamed instead of buffered by a shell
+            tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+            zstd = subprocess.Popen(zstd_cmd, stdin=tar.stdout, stderr=subprocess.PIPE, text=True)
+            tar.stdout.close()  # Allow tar to receive a SIGPIPE if zstd exits early
+            _, zstd_stderr = zstd.communicate()
+            tar.wait()
+            # Check zstd first, as a zstd failure makes tar die with SIGPIPE and the zstd error is the actual cause
+            if zstd.returncode != 0:
+                raise subprocess.CalledProcessError(zstd.returncode, zstd_cmd, stderr=zstd_stderr)
+            if tar.returncode != 0:
+                raise subprocess.CalledProcessError(tar.returncode, tar_cmd)
         else:
             subprocess.run(
-                ['zstd', '-22', '--force', '-o', temp_archive, path],
+                zstd_cmd + [path],
                 check=True,
                 stderr=subprocess.PIPE,
                 text=True
@@ -47,6 +61,12 @@ def estimate_true_information(path, temp_dir=None):
             os.remove(temp_archive)
 
 
+@njit(cache=True)
+def _count_bytes(buffer, byte_counts):
+    for byte in buffer:
+        byte_counts[byte] += 1
+
+
 def calculate_file_entropy(filename):
     """
     Calculate the entropy of a file in bits per byte, with a progress bar.
@@ -61,24 +81,49 @@ def calculate_file_entropy(filename):
     if file_size == 0:
         return 0.0  # Handle empty file
 
-    byte_counts = Counter()
-    total_bytes = 0
-
-    with open(filename, 'rb') as f, tqdm(total=file_size, unit='B', unit_scale=True, desc='Processing') as pbar:
-        while True:
-            chunk = f.read(65536)  # Read in chunks of 64KB
-            if not chunk:
-                break
-            byte_counts.update(chunk)
-            bytes_read = len(chunk)
-            total_bytes += bytes_read
-            pbar.update(bytes_read)
-
-    entropy = 0.0
-    for count in byte_counts.values():
-        p_x = count / total_bytes
-        entropy -= p_x * math.log2(p_x)
-    return entropy
+    byte_counts = np.zeros(256, dtype=np.int64)
+    chunk_size = 1 << 26  # Count in chunks of 64MiB, only to update the progress bar
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            tqdm(total=file_size, unit='B', unit_scale=True, desc='Processing') as pbar:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)  # Hint the kernel to read ahead
+        # Count directly from the memory-mapped file, without copying it into Python bytes objects
+        file_bytes = np.frombuffer(mm, dtype=np.uint8)
+        chunk = None
+        try:
+            for start in range(0, file_size, chunk_size):
+                chunk = file_bytes[start:start + chunk_size]
+                _count_bytes(chunk, byte_counts)
+                pbar.update(len(chunk))
+        except BaseException as e:
+            # The frames in the traceback can still reference the views, so clear them before the file is unmapped
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            del file_bytes, chunk  # The views must be released before the file is unmapped, also on errors
+
+    p_x = byte_counts[byte_counts > 0] / file_size
+    entropy = -(p_x * np.log2(p_x)).sum()
+    return float(entropy)
+
+
+def iter_file_sizes(path):
+    """
+    Recursively yield the size of each file in a directory. Symlinks are not followed, matching how tar archives them.
+    """
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from iter_file_sizes(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.stat(follow_symlinks=False).st_size
+                except OSError as e:
+                    print(f"Warning: Couldn't access {entry.name}: {e}")
+    except OSError as e:
+        print(f"Warning: Couldn't access {path}: {e}")
 
 
 def process_path(path):
@@ -93,13 +138,7 @@ def process_path(path):
         size = os.path.getsize(path)
     else:
         print("Calculating total size...")
-        size = 0
-        for root, _, files in os.walk(path):
-            for file in files:
-                try:
-                    size += os.path.getsize(os.path.join(root, file))
-                except (OSError, PermissionError) as e:
-                    print(f"Warning: Couldn't access {file}: {e}")
+        size = sum(iter_file_sizes(path))
 
     print(f"\nAnalyzing: {path}")
     print(f"Original size: {size / 1000000:.2f} MB")
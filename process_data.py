@@ -5,12 +5,33 @@ import shutil
 import os
 import pandas as pd
 import numpy as np
+from numba import njit
+from joblib import Memory, Parallel, delayed
 from smoother.smooth_SMBG_data import smooth_smbg_data
 
 UNPROCESSED_DATA_PATH = 'unprocessed_data'
+SMOOTHER_CACHE_PATH = os.path.join('.cache', 'smoother')
+
+# Smoother results are cached on disk by their input arrays, so re-running the imputation skips the smoothing
+smooth_smbg_data_cached = Memory(SMOOTHER_CACHE_PATH, verbose=0).cache(smooth_smbg_data)
 
 
 def run_glupredkit_command(command):
+    # Imported here rather than at the top, to keep it out of the imputation worker processes
+    try:
+        from glupredkit.cli import cli as glupredkit_cli
+    except ImportError:
+        glupredkit_cli = None  # Fall back to running the glupredkit executable
+
+    if glupredkit_cli is not None:
+        # Run the command in this interpreter, to skip the startup and imports of a new process for every command
+        try:
+            glupredkit_cli.main(args=command[1:], prog_name=command[0], standalone_mode=False)
+        except Exception as e:
+            print("Errors:")
+            print(e)
+        return
+
     result = subprocess.run(command, capture_output=True, text=True)
     print(result.stdout)
 
@@ -28,54 +49,81 @@ def parse_dataset(parser, file_path, test_size='0.3'):
                             "--test-size", test_size])
 
 
+@njit(cache=True)
+def _forward_fill_with_limit(values, limit):
+    # Zeros are treated as missing, and at most `limit` consecutive missing values are filled with the last value
+    last_value = np.nan
+    gap = 0
+    for i in range(len(values)):
+        if np.isnan(values[i]) or values[i] == 0:
+            gap += 1
+            values[i] = last_value if gap <= limit else np.nan
+        else:
+            last_value = values[i]
+            gap = 0
+    return values
+
+
+@njit(cache=True)
+def _fill_zero_with_limit(values, limit):
+    # Zeros are treated as missing, and stretches of missing values are set to 0 if at most `limit` long, else nan
+    n = len(values)
+    i = 0
+    while i < n:
+        if np.isnan(values[i]) or values[i] == 0:
+            start = i
+            while i < n and (np.isnan(values[i]) or values[i] == 0):
+                i += 1
+            values[start:i] = 0.0 if i - start <= limit else np.nan
+        else:
+            i += 1
+    return values
+
+
 def impute_datasets():
     source_folder = 'processed_data'
     for filename in os.listdir(source_folder):
-        if 'imputed' not in filename and '.DS_Store' not in filename:
-            df = pd.read_csv(os.path.join(source_folder, filename), index_col='date', parse_dates=['date'],
-                             low_memory=False)
+        # Only the raw parsed datasets are CSV, other files like the imputed and derived feature outputs are Parquet
+        if filename.endswith('.csv') and 'imputed' not in filename:
+            df = pd.read_csv(os.path.join(source_folder, filename), engine='pyarrow',
+                             parse_dates=['date']).set_index('date')
+            # The pyarrow engine parses dates with second resolution, so restore the nanosecond index of the
+            # default engine
+            df.index = df.index.as_unit('ns')
             print(f"Processing {filename} with imputation...")
-            all_processed_dfs = []  # List to store processed dataframes
-
-            for subject_id, subset_df in df.groupby('id'):  # Group by the 'id' column
-                for is_test in [True, False]:
-                    subset_split_df = subset_df[subset_df['is_test'] == is_test].copy()
-                    forward_fill_cols = ['galvanic_skin_response', 'skin_temp', 'air_temp', 'heartrate']
-                    for col in [col for col in forward_fill_cols if col in df.columns]:
-                        # First, set 0 to nan
-                        subset_split_df.loc[:, col] = subset_split_df[col].replace(0, np.nan)
-                        # Then, forward fill with upper limit
-                        upper_limit = 12
-                        # subset_split_df[col] = subset_split_df[col].fillna(method='ffill', limit=upper_limit)
-                        subset_split_df.loc[:, col] = subset_split_df[col].fillna(method='ffill', limit=upper_limit)
-
-                    fill_nan_with_zero_cols = ['carbs', 'bolus', 'basal', 'steps', 'acceleration']
-                    for col in [col for col in fill_nan_with_zero_cols if col in subset_split_df.columns]:
-                        # First, set 0 to nan
-                        subset_split_df.loc[:, col] = subset_split_df[col].replace(0, np.nan)
-
-                        # Replace NaN values with 0 if they were filled within the limit
-                        mask = subset_split_df[col].isna()  # Identify NaN values
-                        # subset_split_df[col] = subset_split_df[col].fillna(0)
-                        subset_split_df.loc[:, col] = subset_split_df[col].fillna(0)
-                        # Retain NaN for stretches that exceed the limit
-                        upper_limit = 12*24
-                        subset_split_df.loc[:, col] = subset_split_df[col].where(
-                            ~mask | (mask & mask.shift(upper_limit, fill_value=False)),
-                            np.nan
-                        )
-
-                    # Smoothen Cgm data
-                    subset_split_df = smoothen_cgm_data(subset_split_df)
-                    all_processed_dfs.append(subset_split_df)
+            # Impute each column once over the whole file, separately within each subject's train and test split
+            subject_splits = df.groupby(['id', 'is_test'], sort=False)
+            forward_fill_cols = ['galvanic_skin_response', 'skin_temp', 'air_temp', 'heartrate']
+            for col in [col for col in forward_fill_cols if col in df.columns]:
+                # Set 0 to nan, then forward fill with upper limit
+                upper_limit = 12
+                df[col] = subject_splits[col].transform(
+                    lambda values: _forward_fill_with_limit(values.to_numpy(dtype=float, copy=True), upper_limit))
+
+            fill_nan_with_zero_cols = ['carbs', 'bolus', 'basal', 'steps', 'acceleration']
+            for col in [col for col in fill_nan_with_zero_cols if col in df.columns]:
+                # Set 0 to nan, then replace nan with 0 in stretches within the limit, and retain nan for
+                # stretches that exceed the limit
+                upper_limit = 12*24
+                df[col] = subject_splits[col].transform(
+                    lambda values: _fill_zero_with_limit(values.to_numpy(dtype=float, copy=True), upper_limit))
+
+            # Smoothen Cgm data, with subjects processed in parallel
+            all_processed_dfs = Parallel(n_jobs=-1, backend='loky')(
+                delayed(_process_subject)(subset_df) for _, subset_df in df.groupby('id', sort=False))
 
             df_processed = pd.concat(all_processed_dfs)
-            save_file_name = filename.split('.')[0] + '_imputed.' + filename.split('.')[1]
+            save_file_name = filename.split('.')[0] + '_imputed.parquet'
             save_path = os.path.join(source_folder, save_file_name)
-            df_processed.to_csv(save_path)
+            df_processed.to_parquet(save_path, compression='zstd', row_group_size=100_000)
             print(f"Processed file saved as: {save_path}")
 
 
+def _process_subject(subset_df):
+    return pd.concat([smoothen_cgm_data(subset_split_df.copy())
+                      for _, subset_split_df in subset_df.groupby('is_test', sort=False)])
+
+
 def smoothen_cgm_data(df):
 
     if df['CGM'].isna().all():
@@ -84,7 +132,7 @@ def smoothen_cgm_data(df):
 
     glucose_values = np.array(df['CGM'].values)
     dates = np.array(df.index.values)
-    smoother_result = smooth_smbg_data(dates, glucose_values)
+    smoother_result = smooth_smbg_data_cached(dates, glucose_values)
 
     smoothed_df = pd.DataFrame({'y_smoothed': smoother_result['y_smoothed']}, index=smoother_result['t_i'])
     # Convert smoothed_df index to match df's timezone
@@ -102,25 +150,22 @@ def smoothen_cgm_data(df):
     df = df.copy()  # Explicitly create a new copy to avoid warnings
     window_size = 24
     rolling_nan_count = df['CGM'].isna().rolling(window=window_size, min_periods=1).sum()
-    full_nan_indices = rolling_nan_count[rolling_nan_count == window_size].index
-    for idx in full_nan_indices:
-        window_start = idx - pd.Timedelta(minutes=5 * (window_size - 1))
-        window_end = idx
-        df.loc[window_start:window_end, 'CGM_smoothed'] = np.nan
+    is_full_nan_window_end = rolling_nan_count.eq(window_size)
+    # Spread each full nan window end back over its window with a reversed rolling max
+    in_full_nan_window = is_full_nan_window_end[::-1].rolling(window=window_size, min_periods=1).max()[::-1]
+    df.loc[in_full_nan_window.to_numpy(dtype=bool), 'CGM_smoothed'] = np.nan
     return df
 
 
 def reorganize_results():
     source_folder = os.path.join('data', 'raw')
     destination_folder = 'processed_data'
-    if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
+    os.makedirs(destination_folder, exist_ok=True)
 
     # Move results from data subfolder to a folder named "processed_data"
-    for filename in os.listdir(source_folder):
-        source_file = os.path.join(source_folder, filename)
-        destination_file = os.path.join(destination_folder, filename)
-        shutil.move(source_file, destination_file)
+    with os.scandir(source_folder) as entries:
+        for entry in entries:
+            shutil.move(entry.path, os.path.join(destination_folder, entry.name))
 
     shutil.rmtree('data')
 